@@ -1,18 +1,36 @@
 import os
+import re
+import bisect
+import contextlib
+import asyncio
+import time
+import hashlib
 import logging
+import datetime
 from pathlib import Path
+from typing import TypedDict
+import orjson
+import aiohttp
+import numpy as np
+from cachetools import TTLCache
 from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 from slack_bolt.async_app import AsyncApp
 from slack_bolt.adapter.fastapi.async_handler import AsyncSlackRequestHandler
+from slack_sdk.errors import SlackApiError
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
 
 logging.basicConfig(level=logging.INFO)
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 slack_app = AsyncApp(
     token=os.environ.get("SLACK_BOT_TOKEN"),
     signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
 )
 slack_handler = AsyncSlackRequestHandler(slack_app)
+SLACK_HTTP_POOL_SIZE = 64
+SLACK_HTTP_KEEPALIVE = 60  # 秒
 
 try:
     genai.configure(api_key=os.environ["GEMINI_API_KEY"])
@@ -21,6 +39,18 @@ except KeyError:
     logging.error("環境変数 GEMINI_API_KEY が設定されていません．")
     generative_model = None
 
+# モデルはDockerfileでビルド時にダウンロードしておく．読み込めない場合も埋め込みを使う機能だけを無効にして起動する
+EMBEDDING_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+try:
+    from sentence_transformers import SentenceTransformer
+    embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+except ImportError:
+    logging.warning("sentence-transformers がインストールされていないため、埋め込みを使う機能を無効にします．")
+    embedding_model = None
+except Exception as e:
+    logging.error(f"埋め込みモデル {EMBEDDING_MODEL_NAME} を読み込めないため、埋め込みを使う機能を無効にします: {e}")
+    embedding_model = None
+
 # --- 資料情報リスト ---
 # documentsフォルダにファイルを追加・削除した場合も、ここのリストを更新すればOK
 DOCUMENTS_INFO = [
@@ -56,54 +86,433 @@ DOCUMENTS_INFO = [
 
 DOCUMENTS_DIR = Path(__file__).parent / "documents"
 doc_keywords = [doc["keyword"] for doc in DOCUMENTS_INFO]
+DOCS_BY_KEYWORD = {doc["keyword"]: doc for doc in DOCUMENTS_INFO}
+DOC_TEXTS = {}  # {ファイル名: 資料の本文}．起動時に一度だけ読み込む
+
+# --- プロンプト ---
+# 質問ごとに変わらない部分は起動時に一度だけ組み立てておく
+PERSONA = "あなたは研究室の優秀で親しみやすいアシスタント、おくだくんです．"
+SLACK_FORMAT_RULES = (
+    "# Slack用の書式ルール\n"
+    "* 強調したい単語は、`*単語*` のようにアスタリスクで囲んでください．\n"
+    "* 箇条書きを使う場合は、行頭に `• ` (中黒と半角スペース) を使用してください．\n"
+    "* `**単語**` のような二重アスタリスクや、行頭の `* ` は使用しないでください．"
+)
+TOPIC_DESCRIPTIONS = "\n".join(f"- トピック名: {doc['keyword']}\n  説明: {doc['description']}" for doc in DOCUMENTS_INFO)
+CLASSIFICATION_INSTRUCTION = (
+    "あなたはユーザーの質問内容を分析し、最も関連性の高い資料を判断する専門家です．\n"
+    "以下の質問に答えるのに最適なトピックを、下記のトピックリストから一つだけ選び、その「トピック名」を topic に入れてください．\n"
+    "トピックを選んだ場合、answer は空文字にしてください．\n"
+    "もし、どのトピックにも当てはまらない一般知識の質問の場合は、topic を「一般知識」とし、"
+    "研究室の優秀で親しみやすいアシスタント、おくだくんとして、あなたの持っている一般的な知識を最大限に活用し、"
+    "後輩に教えるような親しみやすく丁寧な口調の回答を answer に入れてください．answer は以下の書式ルールに従ってください．\n\n"
+    f"{SLACK_FORMAT_RULES}\n\n"
+    f"## トピックリスト:\n{TOPIC_DESCRIPTIONS}"
+)
+ANSWER_INSTRUCTION = (
+    f"{PERSONA}\n"
+    "以下の参考情報に厳密に基づいて、丁寧で分かりやすい言葉で回答を生成してください．\n\n"
+    "# 指示\n* 箇条書きを使う場合でも、前後に説明の文章を加えて会話のような自然な流れにしてください．\n"
+    "* 相手は後輩や新入生であることを意識し、親しみやすい口調を心がけてください．\n"
+    "* 参考情報に書かれていないことは、絶対に答えないでください．\n\n"
+    f"{SLACK_FORMAT_RULES}"
+)
+FALLBACK_INSTRUCTION = (
+    "あなたの持っている一般的な知識を最大限に活用し、後輩に教えるような親しみやすく丁寧な口調で応答してください．\n\n"
+    f"{SLACK_FORMAT_RULES}"
+)
+
+# --- 定型の応答 ---
+# 挨拶やお礼、絵文字だけのメッセージには Gemini を呼ばずに決まった返事をする
+TRIVIAL_REPLIES = [
+    (re.compile(r"^(hi|hello|hey|こんにちは|こんばんは|おはよう(ございます)?|はじめまして)[!！?？。．、~～〜ー\s]*$", re.I),
+     "こんにちは！研究室のことで知りたいことがあれば、気軽に聞いてね．"),
+    (re.compile(r"^(ありがとう(ございます|ございました)?|thanks?( you)?|thx|了解(です|しました)?)[!！。．~～〜\s]*$", re.I),
+     "どういたしまして！また何かあればいつでも聞いてね．"),
+    (re.compile(r"^(\s*(:[\w+-]+:|[\U0001F300-\U0001FAFF\u2600-\u27BF\uFE0F]))+\s*$"),
+     "😊 何か聞きたいことがあれば、質問を書いて送ってね．"),
+]
+MIN_QUERY_LENGTH = 3
+SHORT_QUERY_REPLY = "もう少し詳しく教えてくれると、ちゃんと答えられるよ．"
+
+def get_trivial_reply(user_query: str):
+    """Geminiを呼ぶまでもないメッセージなら定型の返事を返す関数．それ以外はNone"""
+    for pattern, reply in TRIVIAL_REPLIES:
+        if pattern.match(user_query):
+            return reply
+    # 「ゼミ」「Git」のように、資料のキーワードの先頭と一致する2文字以上の質問は短くても答える
+    if len(user_query) < MIN_QUERY_LENGTH:
+        query = user_query.lower()
+        if len(query) < 2 or not any(keyword.lower().startswith(query) for keyword in doc_keywords):
+            return SHORT_QUERY_REPLY
+    return None
+
+# --- 応答キャッシュ ---
+# 同じ質問には Gemini を呼ばずに前回の回答を返す．質問にNO_CACHE_TOKENを含めるとキャッシュを使わない
+NO_CACHE_TOKEN = "#nocache"
+GEMINI_UNAVAILABLE_MESSAGE = "Gemini APIキーが設定されていないため、応答できません．"
+GEMINI_ERROR_MESSAGE = "申し訳ありません、AIとの通信中にエラーが発生しました．"
+GEMINI_INCOMPLETE_NOTE = "\n\n（AIとの通信中にエラーが発生したため、回答が途中で終わっています．）"
+response_cache = TTLCache(maxsize=1024, ttl=3600)
+response_cache_lock = asyncio.Lock()
+
+def make_cache_key(user_query: str) -> str:
+    """質問文を正規化してキャッシュのキーを作る関数"""
+    return hashlib.blake2b(user_query.strip().lower().encode('utf-8')).hexdigest()
+
+async def get_cached_response(key: str):
+    """キャッシュから (トピック, 回答) を取り出す関数．無ければNone"""
+    async with response_cache_lock:
+        return response_cache.get(key)
+
+# 言い回しが違うだけの質問は、埋め込みの類似度でチャンネルごとのキャッシュから探す
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_TTL = 24 * 60 * 60
+SEMANTIC_CACHE_MAXSIZE = 1024
+# 複数の話題にまたがる質問は、それぞれに近いキャッシュ済みの回答を統合して答える
+GENERATIVE_CACHE_TOP_K = 3
+GENERATIVE_CACHE_SINGLE_THRESHOLD = 0.65
+GENERATIVE_CACHE_COMBINED_THRESHOLD = 1.4
+semantic_cache = {}  # {チャンネルID: {"vectors": 質問ベクトルの行列, "entries": [(回答, トピック, 保存時刻)]}}
+
+async def embed_text(text: str):
+    """文章をL2正規化した埋め込みベクトルに変換する関数．モデルが無ければNone"""
+    if not embedding_model:
+        return None
+    return await asyncio.to_thread(embedding_model.encode, text, normalize_embeddings=True)
+
+def search_semantic_cache(namespace: str, query_vector, k: int = 1):
+    """類似度の高い順に (類似度, 回答, トピック) を最大k件返す関数"""
+    store = semantic_cache.get(namespace)
+    if not store:
+        return []
+    # 古いものから順に追加しているので、期限切れは先頭にまとまっている
+    expire_before = time.time() - SEMANTIC_CACHE_TTL
+    alive = next((i for i, entry in enumerate(store["entries"]) if entry[2] >= expire_before), len(store["entries"]))
+    if alive:
+        store["vectors"] = store["vectors"][alive:]
+        store["entries"] = store["entries"][alive:]
+    if not store["entries"]:
+        return []
+    sims = store["vectors"] @ query_vector
+    top = np.argsort(-sims)[:k]
+    return [(float(sims[i]), store["entries"][i][0], store["entries"][i][1]) for i in top]
+
+def add_semantic_cache(namespace: str, query_vector, topic: str, reply_text: str):
+    """質問ベクトルと回答をチャンネルごとのキャッシュに追加する関数"""
+    store = semantic_cache.setdefault(namespace, {"vectors": np.empty((0, len(query_vector)), dtype=np.float32), "entries": []})
+    store["vectors"] = np.vstack([store["vectors"], query_vector])[-SEMANTIC_CACHE_MAXSIZE:]
+    store["entries"] = (store["entries"] + [(reply_text, topic, time.time())])[-SEMANTIC_CACHE_MAXSIZE:]
 
-async def get_gemini_response(prompt: str) -> str:
-    """Gemini APIを呼び出し、応答を生成する関数"""
+async def cache_reply(key: str, namespace: str, query_vector, topic: str, reply_text: str):
+    """エラー以外の回答を完全一致と意味的キャッシュの両方に保存する関数"""
+    if reply_text.startswith((GEMINI_UNAVAILABLE_MESSAGE, GEMINI_ERROR_MESSAGE)) or reply_text.endswith(GEMINI_INCOMPLETE_NOTE):
+        return
+    async with response_cache_lock:
+        response_cache[key] = (topic, reply_text)
+    if query_vector is not None:
+        add_semantic_cache(namespace, query_vector, topic, reply_text)
+
+# --- Geminiのコンテキストキャッシュ ---
+# 資料と回答ルールをサーバー側にキャッシュし、リクエストごとには質問だけを送る
+# コンテキストキャッシュはバージョン付きのモデル名が必要．資料が短すぎて作れない場合は毎回プロンプトに埋め込む
+CONTEXT_CACHE_MODEL_NAME = "models/gemini-2.0-flash-001"
+CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)
+context_caches = {}  # {ファイル名: CachedContent}
+context_cache_retry_at = {}  # {ファイル名: 作成に失敗した資料を次に試す時刻}
+context_cache_unsupported = set()  # 短すぎるなどでキャッシュを作れない資料．二度と作成を試さない
+context_cache_locks = {}  # {ファイル名: 同じ資料のキャッシュを二重に作らないためのロック}
+background_tasks = set()  # 先読みのタスクが途中で破棄されないように参照を持っておく
+
+async def get_context_cached_model(filename: str, context_text: str):
+    """資料をコンテキストキャッシュに載せたモデルを返す関数．使えない場合はNone"""
+    if not generative_model or filename in context_cache_unsupported:
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if context_cache_retry_at.get(filename, now) > now:
+        return None
+    async with context_cache_locks.setdefault(filename, asyncio.Lock()):
+        cached_content = context_caches.get(filename)
+        if cached_content is None or cached_content.expire_time <= now:
+            try:
+                cached_content = await asyncio.to_thread(
+                    caching.CachedContent.create,
+                    model=CONTEXT_CACHE_MODEL_NAME,
+                    display_name=filename,
+                    system_instruction=ANSWER_INSTRUCTION,
+                    contents=[f"# 参考情報 (出典: {filename})\n{context_text}"],
+                    ttl=CONTEXT_CACHE_TTL,
+                )
+            except google_exceptions.InvalidArgument as e:
+                # 資料が最小トークン数に満たない場合など．資料は変わらないので作り直しても通らない
+                logging.info(f"{filename} はコンテキストキャッシュを使わずに答えます: {e}")
+                context_caches.pop(filename, None)
+                context_cache_unsupported.add(filename)
+                return None
+            except Exception as e:
+                logging.warning(f"{filename} のコンテキストキャッシュを作成できませんでした: {e}")
+                context_caches.pop(filename, None)
+                context_cache_retry_at[filename] = now + CONTEXT_CACHE_TTL
+                return None
+            context_caches[filename] = cached_content
+            logging.info(f"{filename} のコンテキストキャッシュを作成しました．")
+        elif cached_content.expire_time - now < CONTEXT_CACHE_TTL / 2:
+            # よく使われる資料は期限を延長しておく．失敗しても期限まではそのまま使える
+            try:
+                await asyncio.to_thread(cached_content.update, ttl=CONTEXT_CACHE_TTL)
+            except Exception as e:
+                logging.warning(f"{filename} のコンテキストキャッシュの期限を延長できませんでした: {e}")
+    return genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+
+# --- トピック分類 ---
+# 分類と一般知識の回答を一度の呼び出しでJSONとして受け取り、一般知識の質問で二回目の呼び出しを省く
+class TopicAnswer(TypedDict):
+    topic: str
+    answer: str
+
+# 埋め込みで十分に確信できる質問は、Geminiに分類させずに資料を決める
+ROUTER_THRESHOLD = 0.45
+ROUTER_MARGIN = 0.05
+doc_embeddings = None  # DOCUMENTS_INFO と同じ順の資料ベクトルの行列．起動時に作る
+
+CLASSIFICATION_CONFIG = genai.GenerationConfig(response_mime_type="application/json", response_schema=TopicAnswer)
+TOPIC_SANITIZE = str.maketrans('', '', "'\"．*")  # トピック名から取り除く記号
+
+def rank_documents(query_vector):
+    """質問との類似度が高い順に (類似度, 資料情報) を返す関数．同じファイルの資料は一つにまとめる"""
+    if doc_embeddings is None or query_vector is None:
+        return []
+    sims = doc_embeddings @ query_vector
+    ranked, seen_files = [], set()
+    for i in np.argsort(-sims):
+        doc = DOCUMENTS_INFO[i]
+        if doc["filename"] not in seen_files:
+            seen_files.add(doc["filename"])
+            ranked.append((float(sims[i]), doc))
+    return ranked
+
+def route_topic(ranked_docs):
+    """類似度の一位が閾値を超え、二位との差も十分なときだけそのトピック名を返す関数．それ以外はNone"""
+    if not ranked_docs or ranked_docs[0][0] < ROUTER_THRESHOLD:
+        return None
+    if len(ranked_docs) > 1 and ranked_docs[0][0] - ranked_docs[1][0] < ROUTER_MARGIN:
+        return None
+    return ranked_docs[0][1]["keyword"]
+
+# --- 資料の分割 ---
+# プロンプトに入れる資料の上限を超える長い資料だけ、まとまりごとに分けてベクトルを持っておき、
+# 質問に近い部分を上限まで入れる．上限に収まる資料は手順が欠けないように全文を使う
+DOC_CHUNK_SIZE = 400
+DOC_PROMPT_BUDGET = 30000  # 字数．これ以下の資料は分けずにそのまま使う
+DOC_CHUNKS = {}  # {ファイル名: (まとまりのリスト, まとまりのベクトルの行列)}
+
+def split_document(text: str):
+    """資料を見出し([...])や空行の位置で、おおよそDOC_CHUNK_SIZE字ずつのまとまりに分ける関数"""
+    chunks, lines, length = [], [], 0
+    for line in text.splitlines():
+        at_boundary = not line.strip() or line.startswith("[")
+        if lines and (length >= DOC_CHUNK_SIZE * 2 or (at_boundary and length >= DOC_CHUNK_SIZE)):
+            chunks.append("\n".join(lines).strip())
+            lines, length = [], 0
+        lines.append(line)
+        length += len(line) + 1
+    if lines:
+        chunks.append("\n".join(lines).strip())
+    return [chunk for chunk in chunks if chunk]
+
+def select_relevant_chunks(filename: str, context_text: str, query_vector) -> str:
+    """質問に近いまとまりを上限の字数まで、元の順番のまま取り出す関数．分割していない資料はそのまま返す"""
+    entry = DOC_CHUNKS.get(filename)
+    if entry is None or query_vector is None:
+        return context_text
+    chunks, vectors = entry
+    selected, length = [], 0
+    for i in np.argsort(-(vectors @ query_vector)):
+        if length + len(chunks[i]) > DOC_PROMPT_BUDGET:
+            break
+        selected.append(i)
+        length += len(chunks[i])
+    return "\n\n（中略）\n\n".join(chunks[i] for i in sorted(selected))
+
+def parse_classification(text: str):
+    """分類結果のJSONから (トピック, 一般知識の回答) を取り出す関数．JSONでなければ回答は空"""
+    try:
+        result = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return text, ""
+    if not isinstance(result, dict):
+        return text, ""
+    return str(result.get("topic", "")), str(result.get("answer", "")).strip()
+
+SAFETY_SETTINGS = {
+    'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE',
+    'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE',
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE',
+    'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE',
+}
+SLACK_MESSAGE_LIMIT = 3000
+SPLIT_CHAR_PATTERN = re.compile(r"[．\n]")  # 長いメッセージを分割するときの区切り文字
+# 一つの長いメッセージを分割して同時に投稿する数と、レート制限を受けたときに投稿し直す回数
+SLACK_POST_CONCURRENCY = 3
+SLACK_POST_MAX_RETRIES = 3
+# ストリーミング中の途中経過の更新間隔．Slackのchat.updateの制限（おおむね1秒に1回）に合わせる
+STREAM_UPDATE_INTERVAL = 1.0
+
+async def get_gemini_response(prompt: str, model=None, generation_config=None) -> str:
+    """Gemini APIを呼び出し、応答を生成する関数．modelを渡すとそのモデルで生成する"""
     if not generative_model:
-        return "Gemini APIキーが設定されていないため、応答できません．"
+        return GEMINI_UNAVAILABLE_MESSAGE
+    model = model or generative_model
     try:
-        safety_settings = {
-            'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE',
-            'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE',
-            'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE',
-            'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE',
-        }
-        response = await generative_model.generate_content_async(prompt, safety_settings=safety_settings)
+        response = await model.generate_content_async(prompt, safety_settings=SAFETY_SETTINGS, generation_config=generation_config)
         return response.text
     except Exception as e:
         logging.error(f"Gemini API Error: {e}")
-        return f"申し訳ありません、AIとの通信中にエラーが発生しました．({e})"
+        return f"{GEMINI_ERROR_MESSAGE}({e})"
+
+async def stream_gemini_response(client, channel: str, ts: str, thread_ts: str, prompt: str, model=None) -> str:
+    """Geminiの応答をストリーミングで受け取り、考え中のメッセージを途中経過で更新しながら投稿する関数"""
+    if not generative_model:
+        reply_text = GEMINI_UNAVAILABLE_MESSAGE
+    else:
+        model = model or generative_model
+        reply_text = ""
+        try:
+            response = await model.generate_content_async(prompt, safety_settings=SAFETY_SETTINGS, stream=True)
+            last_update, shown_len = time.monotonic(), 0
+            async for chunk in response:
+                # 最後のチャンクや安全性で止まったチャンクには本文が無く、.text が例外を投げる
+                if not (chunk.candidates and chunk.candidates[0].content.parts):
+                    continue
+                reply_text += chunk.text
+                now = time.monotonic()
+                if now - last_update >= STREAM_UPDATE_INTERVAL and shown_len < len(reply_text) <= SLACK_MESSAGE_LIMIT:
+                    last_update = now
+                    # 途中経過の更新は失敗しても回答の生成を続ける
+                    try:
+                        await client.chat_update(channel=channel, ts=ts, text=reply_text)
+                        shown_len = len(reply_text)
+                    except (SlackApiError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        logging.warning(f"途中経過の更新に失敗しました: {e!r}")
+        except Exception as e:
+            logging.error(f"Gemini API Error: {e}")
+            if reply_text:
+                # 途中まで生成できた回答は捨てずに返す（途中で終わったのでキャッシュはしない）
+                reply_text += GEMINI_INCOMPLETE_NOTE
+            else:
+                reply_text = f"{GEMINI_ERROR_MESSAGE}({e})"
+    await post_reply(client, channel=channel, ts=ts, thread_ts=thread_ts, text=reply_text)
+    return reply_text
+
+async def post_reply(client, channel: str, ts: str, thread_ts: str, text: str):
+    """考え中のメッセージを回答で置き換える関数．長い回答は分割してスレッドに投稿する"""
+    if len(text) <= SLACK_MESSAGE_LIMIT:
+        await client.chat_update(channel=channel, ts=ts, text=text)
+        return
+    await asyncio.gather(
+        client.chat_delete(channel=channel, ts=ts),
+        send_long_message(client, channel=channel, thread_ts=thread_ts, text=text),
+    )
+
+async def classify_with_gemini(user_query: str):
+    """Geminiに質問を分類させ、(トピック名, 一般知識の回答) を返す関数"""
+    classification_prompt = f"{CLASSIFICATION_INSTRUCTION}\n\n## 質問:\n{user_query}"
+    classification = await get_gemini_response(classification_prompt, generation_config=CLASSIFICATION_CONFIG)
+    topic, general_answer = parse_classification(classification)
+    topic = topic.strip().translate(TOPIC_SANITIZE)
+    return topic, general_answer
+
+async def post_message(client, channel: str, thread_ts: str, text: str, semaphore: asyncio.Semaphore = None):
+    """スレッドに投稿する関数．レート制限(429)を受けたらsemaphoreの枠を空けてRetry-Afterの秒数だけ待ち、投稿し直す"""
+    for attempt in range(SLACK_POST_MAX_RETRIES + 1):
+        try:
+            async with semaphore or contextlib.nullcontext():
+                return await client.chat_postMessage(channel=channel, thread_ts=thread_ts, text=text)
+        except SlackApiError as e:
+            if e.response.status_code != 429 or attempt == SLACK_POST_MAX_RETRIES:
+                raise
+            retry_after = int(e.response.headers.get("Retry-After", 1))
+        logging.warning(f"Slackのレート制限を受けたため {retry_after} 秒後に投稿し直します．")
+        await asyncio.sleep(retry_after)
 
 async def send_long_message(client, channel: str, thread_ts: str, text: str):
     """3000字を超えるメッセージを分割してスレッドに投稿する関数"""
-    limit = 3000
+    limit = SLACK_MESSAGE_LIMIT
     if len(text) <= limit:
-        await client.chat_postMessage(channel=channel, thread_ts=thread_ts, text=text)
+        await post_message(client, channel=channel, thread_ts=thread_ts, text=text)
         return
+    # 区切り文字の位置を一度だけ走査しておき、各分割点は二分探索で求める
+    break_positions = {"．": [], "\n": []}
+    for match in SPLIT_CHAR_PATTERN.finditer(text):
+        break_positions[match.group()].append(match.start())
     parts = []
     current_pos = 0
     while current_pos < len(text):
-        split_pos = text.rfind("．", current_pos, current_pos + limit)
-        if split_pos == -1:
-            split_pos = text.rfind("\n", current_pos, current_pos + limit)
-        
+        split_pos = -1
+        for positions in (break_positions["．"], break_positions["\n"]):
+            index = bisect.bisect_left(positions, current_pos + limit) - 1
+            if index >= 0 and positions[index] >= current_pos:
+                split_pos = positions[index]
+                break
+
         if split_pos == -1 or split_pos <= current_pos:
             split_pos = current_pos + limit
         
         parts.append(text[current_pos:split_pos+1])
         current_pos = split_pos + 1
     
-    for i, part in enumerate(parts):
-        part_text = f"*{i+1}/{len(parts)}*\n\n{part}"
-        await client.chat_postMessage(channel=channel, thread_ts=thread_ts, text=part_text)
+    # 最初の部分を先に投稿してスレッドの先頭に置き、残りは並行して投稿する（順番は番号で分かる）
+    part_texts = [f"*{i+1}/{len(parts)}*\n\n{part}" for i, part in enumerate(parts)]
+    await post_message(client, channel=channel, thread_ts=thread_ts, text=part_texts[0])
+    semaphore = asyncio.Semaphore(SLACK_POST_CONCURRENCY)
+    await asyncio.gather(*[
+        post_message(client, channel=channel, thread_ts=thread_ts, text=part_text, semaphore=semaphore)
+        for part_text in part_texts[1:]
+    ])
 
 @app.on_event("startup")
 async def startup_event():
-    """起動時に資料リストをログに出力する"""
+    """起動時に資料リストをログに出力し、資料の読み込みと分割、ベクトルの計算を行う"""
+    global doc_embeddings
+    # Slack APIへの接続を使い回すため、ボルトのクライアントに共有のセッションを持たせる
+    # (リクエストごとのクライアントもこのセッションを引き継ぐ．Geminiは gRPC のチャネルを使い回している)
+    if slack_app.client.session is None:
+        connector = aiohttp.TCPConnector(limit=SLACK_HTTP_POOL_SIZE, keepalive_timeout=SLACK_HTTP_KEEPALIVE)
+        # 渡したセッションにはクライアントのtimeoutが効かないので、同じ値をセッション側に設定する
+        slack_app.client.session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=slack_app.client.timeout)
+        )
     logging.info(f"以下の資料をキーワードで認識しました: {doc_keywords}")
+    for doc in DOCUMENTS_INFO:
+        if doc["filename"] in DOC_TEXTS:
+            continue
+        try:
+            DOC_TEXTS[doc["filename"]] = (DOCUMENTS_DIR / doc["filename"]).read_text(encoding='utf-8')
+        except OSError as e:
+            logging.error(f"資料 {doc['filename']} を読み込めませんでした: {e}")
     if not doc_keywords:
         logging.warning("警告: DOCUMENTS_INFOリストが空です．")
+    elif embedding_model:
+        doc_embeddings = await asyncio.to_thread(
+            embedding_model.encode,
+            [f"{doc['description']} {doc['keyword']}" for doc in DOCUMENTS_INFO],
+            normalize_embeddings=True,
+        )
+        for filename, text in DOC_TEXTS.items():
+            if len(text) <= DOC_PROMPT_BUDGET or filename in DOC_CHUNKS:
+                continue
+            chunks = split_document(text)
+            vectors = await asyncio.to_thread(embedding_model.encode, chunks, normalize_embeddings=True)
+            DOC_CHUNKS[filename] = (chunks, vectors)
+        if DOC_CHUNKS:
+            logging.info(f"以下の資料を分割しました: {list(DOC_CHUNKS)}")
         
+@app.on_event("shutdown")
+async def shutdown_event():
+    """終了時に共有のセッションを閉じる"""
+    if slack_app.client.session is not None:
+        await slack_app.client.session.close()
+
 @app.get("/health")
 async def health_check():
     """Renderのヘルスチェック用"""
@@ -129,56 +538,120 @@ async def handle_message(event, say, client, context):
         else:
             user_query = event['text'].strip()
 
+        use_cache = NO_CACHE_TOKEN not in user_query
+        user_query = user_query.replace(NO_CACHE_TOKEN, "").strip()
+
         if not user_query:
             return
 
         channel_id = event['channel']
         thread_ts = event.get('thread_ts') or event.get('ts')
 
+        trivial_reply = get_trivial_reply(user_query)
+        if trivial_reply:
+            await say(text=trivial_reply, thread_ts=thread_ts)
+            return
+
+        cache_key = make_cache_key(user_query)
+        merge_candidates = []
+        if use_cache:
+            cached = await get_cached_response(cache_key)
+            if cached:
+                topic, reply_text = cached
+                logging.info(f"キャッシュから応答しました (トピック: {topic})")
+                await send_long_message(client, channel=channel_id, thread_ts=thread_ts, text=reply_text)
+                return
+
+        query_vector = await embed_text(user_query)
+        if use_cache and query_vector is not None:
+            hits = search_semantic_cache(channel_id, query_vector, k=GENERATIVE_CACHE_TOP_K)
+            if hits and hits[0][0] >= SEMANTIC_CACHE_THRESHOLD:
+                similarity, reply_text, topic = hits[0]
+                logging.info(f"類似した質問のキャッシュから応答しました (トピック: {topic}, 類似度: {similarity:.3f})")
+                await send_long_message(client, channel=channel_id, thread_ts=thread_ts, text=reply_text)
+                return
+            merge_candidates = [hit for hit in hits if hit[0] > GENERATIVE_CACHE_SINGLE_THRESHOLD]
+            # 同じ話題の回答しか無い場合は統合せず、資料を読んで答える
+            if (len({hit[2] for hit in merge_candidates}) < 2
+                    or sum(hit[0] for hit in merge_candidates) <= GENERATIVE_CACHE_COMBINED_THRESHOLD):
+                merge_candidates = []
+
         thinking_message = await say(text="🤔 どの資料を読めばいいか考えています...", thread_ts=thread_ts)
 
         try:
 
-            topic_descriptions = "\n".join([f"- トピック名: {doc['keyword']}\n  説明: {doc['description']}" for doc in DOCUMENTS_INFO])
-            classification_prompt = (
-                f"あなたはユーザーの質問内容を分析し、最も関連性の高い資料を判断する専門家です．\n"
-                f"以下の質問に答えるのに最適なトピックを、下記のトピックリストから一つだけ選び、その「トピック名」だけを答えてください．\n"
-                f"もし、どのトピックにも当てはまらない一般知識の質問の場合は、「一般知識」と答えてください．\n\n"
-                f"## 質問:\n{user_query}\n\n"
-                f"## トピックリスト:\n{topic_descriptions}\n\n"
-                f"## 回答（トピック名一つだけ）："
-            )
-            
-            topic = await get_gemini_response(classification_prompt)
-            topic = topic.strip().replace("'", "").replace('"', '').replace('．', '').replace('*', '')
+            if merge_candidates:
+                topics = [hit[2] for hit in merge_candidates]
+                logging.info(f"キャッシュ済みの回答を統合して応答します (トピック: {topics})")
+                cached_answers = "\n\n".join(f"## 回答{i+1}\n{hit[1]}" for i, hit in enumerate(merge_candidates))
+                merge_query = (
+                    f"以下{len(merge_candidates)}つの回答を統合して、質問に対する一つの自然な返答にしてください．\n"
+                    f"回答に書かれていないことは付け加えず、Slack用の書式（強調は `*単語*`、箇条書きは `• `）を保ってください．\n\n"
+                    f"# 質問\n{user_query}\n\n"
+                    f"{cached_answers}"
+                )
+                reply_text = await stream_gemini_response(
+                    client, channel=channel_id, ts=thinking_message['ts'], thread_ts=thread_ts, prompt=merge_query
+                )
+                await cache_reply(cache_key, channel_id, query_vector, "・".join(topics), reply_text)
+                return
+
+            ranked_docs = rank_documents(query_vector)
+            topic = route_topic(ranked_docs)
+            general_answer = ""
+            speculative_file, speculative_task = None, None
+            if topic:
+                logging.info(f"埋め込みでトピックを決めました (トピック: {topic}, 類似度: {ranked_docs[0][0]:.3f})")
+            else:
+                # Geminiが分類している間に、埋め込みで一番近い資料のコンテキストキャッシュを先に用意しておく
+                if ranked_docs and ranked_docs[0][1]["filename"] in DOC_TEXTS:
+                    speculative_file = ranked_docs[0][1]["filename"]
+                    speculative_task = asyncio.create_task(get_context_cached_model(speculative_file, DOC_TEXTS[speculative_file]))
+                    background_tasks.add(speculative_task)
+                    speculative_task.add_done_callback(background_tasks.discard)
+                topic, general_answer = await classify_with_gemini(user_query)
 
-            selected_doc_info = next((doc for doc in DOCUMENTS_INFO if doc["keyword"] == topic), None)
+            selected_doc_info = DOCS_BY_KEYWORD.get(topic)
+            # 起動時に読み込めなかった資料は、資料が見つからなかったときと同じく一般知識で答える
+            context_text = DOC_TEXTS.get(selected_doc_info["filename"]) if selected_doc_info else None
 
-            if selected_doc_info:
+            if context_text is not None:
                 selected_file = selected_doc_info["filename"]
-                await client.chat_update(
-                    channel=channel_id, ts=thinking_message['ts'], text=f"🤔 関連する資料を読んでるよ．ちょっと待ってね"
+                if selected_file == speculative_file:
+                    cached_model_task = speculative_task
+                else:
+                    cached_model_task = get_context_cached_model(selected_file, context_text)
+                _, cached_model = await asyncio.gather(
+                    client.chat_update(
+                        channel=channel_id, ts=thinking_message['ts'], text=f"🤔 関連する資料を読んでるよ．ちょっと待ってね"
+                    ),
+                    cached_model_task,
                 )
-                
-                context_text = (DOCUMENTS_DIR / selected_file).read_text(encoding='utf-8')
-
-                final_query = (
-                    f"あなたは研究室の優秀で親しみやすいアシスタント、おくだくんです．\n"
-                    f"以下の参考情報に厳密に基づいて、丁寧で分かりやすい言葉で回答を生成してください．\n\n"
-                    f"# 指示\n* 箇条書きを使う場合でも、前後に説明の文章を加えて会話のような自然な流れにしてください．\n"
-                    f"* 相手は後輩や新入生であることを意識し、親しみやすい口調を心がけてください．\n"
-                    f"* 参考情報に書かれていないことは、絶対に答えないでください．\n\n"
-                    f"# Slack用の書式ルール\n"
-                    f"* 強調したい単語は、`*単語*` のようにアスタリスクで囲んでください．\n"
-                    f"* 箇条書きを使う場合は、行頭に `• ` (中黒と半角スペース) を使用してください．\n"
-                    f"* `**単語**` のような二重アスタリスクや、行頭の `* ` は使用しないでください．\n\n"
-                    f"# 参考情報 (出典: {selected_file})\n{context_text}\n\n"
-                    f"# 質問\n{user_query}"
-                )
-                
-                reply_text = await get_gemini_response(final_query)
-                await client.chat_delete(channel=channel_id, ts=thinking_message['ts'])
-                await send_long_message(client, channel=channel_id, thread_ts=thread_ts, text=reply_text)
+                if cached_model:
+                    reply_text = await stream_gemini_response(
+                        client, channel=channel_id, ts=thinking_message['ts'], thread_ts=thread_ts,
+                        prompt=f"# 質問\n{user_query}", model=cached_model
+                    )
+                else:
+                    # サーバー側にキャッシュできない資料は、質問に近い部分だけを送る
+                    relevant_text = select_relevant_chunks(selected_file, context_text, query_vector)
+                    final_query = (
+                        f"{ANSWER_INSTRUCTION}\n\n"
+                        f"# 参考情報 (出典: {selected_file})\n{relevant_text}\n\n"
+                        f"# 質問\n{user_query}"
+                    )
+                    reply_text = await stream_gemini_response(
+                        client, channel=channel_id, ts=thinking_message['ts'], thread_ts=thread_ts, prompt=final_query
+                    )
+                if use_cache:
+                    await cache_reply(cache_key, channel_id, query_vector, topic, reply_text)
+
+            elif general_answer:
+                reply_text = general_answer
+                if use_cache:
+                    await cache_reply(cache_key, channel_id, query_vector, "一般知識", reply_text)
+
+                await post_reply(client, channel=channel_id, ts=thinking_message['ts'], thread_ts=thread_ts, text=reply_text)
 
             else:
 
@@ -187,18 +660,16 @@ async def handle_message(event, say, client, context):
                 )
                 
                 fallback_query = (
-                    f"あなたは研究室の優秀で親しみやすいアシスタント、おくだくんです．\n"
+                    f"{PERSONA}\n"
                     f"「{user_query}」という質問を受けましたが、手元に関連する資料がありませんでした．\n"
-                    f"あなたの持っている一般的な知識を最大限に活用し、後輩に教えるような親しみやすく丁寧な口調で応答してください．\n\n"
-                    f"# Slack用の書式ルール\n"
-                    f"* 強調したい単語は、`*単語*` のようにアスタリスクで囲んでください．\n"
-                    f"* 箇条書きを使う場合は、行頭に `• ` (中黒と半角スペース) を使用してください．\n"
-                    f"* `**単語**` のような二重アスタリスクや、行頭の `* ` は使用しないでください．"
+                    f"{FALLBACK_INSTRUCTION}"
                 )
 
-                reply_text = await get_gemini_response(fallback_query)
-
-                await client.chat_update(channel=channel_id, ts=thinking_message['ts'], text=reply_text)
+                reply_text = await stream_gemini_response(
+                    client, channel=channel_id, ts=thinking_message['ts'], thread_ts=thread_ts, prompt=fallback_query
+                )
+                if use_cache:
+                    await cache_reply(cache_key, channel_id, query_vector, "一般知識", reply_text)
 
         except Exception as e:
             logging.error(f"メッセージ処理中のエラー: {e}")